@@ -0,0 +1,278 @@
+#> !P3!
+
+###
+### xalert: Alert rules, evaluated by xlog on each record it stores,
+###         in a thread of their own (see --alert_ini).
+###
+###   An ini file, a section per rule:
+###
+###     [nx01-errors]
+###     id       = nx01, nx02       # _id's the rule applies to, or *
+###     when     = _el >= 4; status == 404
+###                                 # predicates, ';'-separated, all must hold
+###     count    = 10               # matches (per _id) ...
+###     window   = 60               # ... within this many secs, to fire
+###     cooldown = 300              # secs after firing before firing again
+###     action   = cmd: notify-send xlog "{rule}: {count} in {window}s from {_id}"
+###
+###   Predicates: key op value, op one of
+###     ==  !=          string equality (non-str fields json'd: 4 == "4")
+###     <  <=  >  >=    numeric (fields that aren't numbers don't match)
+###     ~   !~          regex search
+###   Values may be quoted.  A missing key is None (json'd: null).
+###
+###   Actions ('name: arg', a line each), see ACTIONS / register_action:
+###     cmd: <command line>     Run (no shell, not waited for).
+###     file: <pfn>             Append the alert as a json line.
+###     record                  A synthetic record into xlog itself.
+###   {rule}, {count}, {window}, {_id} and the record's keys can be
+###   used in cmd args.
+###
+###   Rules are compiled once (predicates into closures) and indexed by
+###   _id, so a record only meets the rules for its _id (and *).  * rules
+###   with an == predicate are indexed by its key and value too, so they
+###   cost a dict lookup per key, however many there are.  The window is
+###   a deque of the last count match times per (rule, _id): firing is
+###   one comparison, whatever the count.  Per-_id state is pruned once
+###   it's past window and cooldown, and is kept for at most MAXIDS _id's
+###   per rule (matches from more aren't counted).
+###
+
+import re, json, time, shlex, threading, subprocess, collections, configparser
+
+ENCODING    = 'utf-8'
+ERRORS      = 'strict'
+
+MAXIDS = 10000          # _id's tracked per rule.
+PRUNE = 60.0            # Secs between prunings of stale per-_id state.
+
+# A record value as a string, for == != ~.
+def _str(v):
+    return v if isinstance(v, str) else json.dumps(v, sort_keys=True)
+
+def _num(v):
+    if isinstance(v, bool) or v is None:
+        raise ValueError('not a number: %r' % v)
+    return float(v)
+
+PREDICATE = re.compile(r'^\s*([^\s=!<>~]+)\s*(==|!=|<=|>=|<|>|!~|~)\s*(.*?)\s*$')
+
+def compile_predicate(z):
+    """'key op value' -> f(logdict) -> bool."""
+    m = PREDICATE.match(z)
+    if not m:
+        raise ValueError('bad predicate: %r' % z)
+    key, op, value = m.groups()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        value = value[1:-1]
+    if op in ('<', '<=', '>', '>='):
+        num = _num(value)
+        cmp = {'<':  lambda a: a <  num,
+               '<=': lambda a: a <= num,
+               '>':  lambda a: a >  num,
+               '>=': lambda a: a >= num}[op]
+        def f(d):
+            try:
+                return cmp(_num(d.get(key)))
+            except (TypeError, ValueError):
+                return False
+        return f
+    if op == '==':
+        f = lambda d: _str(d.get(key)) == value
+        f.eq = (key, value)             # For indexing.
+        return f
+    if op == '!=':
+        return lambda d: _str(d.get(key)) != value
+    rx = re.compile(value)
+    if op == '~':
+        return lambda d: rx.search(_str(d.get(key))) is not None
+    return lambda d: rx.search(_str(d.get(key))) is None
+
+####################################################################################################
+
+# Actions.  A factory(arg, engine) -> f(alert), alert a dict.
+
+class _SafeDict(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+def cmd_action(arg, engine):
+    argv = shlex.split(arg)
+    def f(alert):
+        fields = _SafeDict(alert['rec'])
+        fields.update(alert)
+        subprocess.Popen([a.format_map(fields) for a in argv],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return f
+
+def file_action(arg, engine):
+    lock = threading.Lock()
+    def f(alert):
+        z = json.dumps(alert, ensure_ascii=True, sort_keys=True) + '\n'
+        with lock:
+            with open(arg, 'a', encoding=ENCODING, errors=ERRORS) as af:
+                af.write(z)
+    return f
+
+def record_action(arg, engine):
+    def f(alert):
+        if engine.emit:
+            engine.emit(alert)
+    return f
+
+ACTIONS = {
+    'cmd':    cmd_action,
+    'file':   file_action,
+    'record': record_action,
+}
+
+def register_action(name, factory):
+    """Add an action type: factory(arg, engine) -> f(alert)."""
+    ACTIONS[name] = factory
+
+####################################################################################################
+
+class Rule(object):
+
+    def __init__(self, name, ids, predicates, count=1, window=0.0, cooldown=0.0, actions=()):
+        self.name = name
+        self.ids = ids                  # _id's, or ('*', ).
+        self.predicates = predicates    # Compiled.
+        self.count = count
+        self.window = window
+        self.cooldown = cooldown
+        self.actions = actions          # Compiled.
+        self.times = {}                 # _id -> deque of the last count match times.
+        self.fired = {}                 # _id -> last firing time.
+        self.untracked = 0              # Matches not counted (over MAXIDS _id's).
+        # An == predicate's (key, value), for indexing * rules.
+        self.eq = next((p.eq for p in predicates if hasattr(p, 'eq')), None)
+
+    def match(self, d):
+        for p in self.predicates:
+            if not p(d):
+                return False
+        return True
+
+    # A match at now: record it, return True if the rule should fire.
+    # (Under the engine's lock.)
+    def hit(self, _id, now):
+        dq = self.times.get(_id)
+        if dq is None:
+            if len(self.times) >= MAXIDS:
+                self.untracked += 1
+                return False
+            dq = self.times[_id] = collections.deque(maxlen=self.count)
+        dq.append(now)
+        if len(dq) < self.count or (now - dq[0]) > self.window:
+            return False
+        if (now - self.fired.get(_id, -1e99)) < self.cooldown:
+            return False
+        self.fired[_id] = now
+        dq.clear()
+        return True
+
+    # Forget _id's whose matches are all past the window, and firings past
+    # the cooldown: they can't affect a firing any more.  (Under the lock.)
+    def prune(self, now):
+        for _id in [k for k, dq in self.times.items() if not dq or (now - dq[-1]) > self.window]:
+            del self.times[_id]
+        for _id in [k for k, t in self.fired.items() if (now - t) >= self.cooldown]:
+            del self.fired[_id]
+
+class AlertEngine(object):
+
+    def __init__(self, emit=None, log=None):
+        self.emit = emit                # f(alert), for the record action.
+        self.log = log or (lambda z: None)
+        self.lock = threading.Lock()
+        self.pruned = time.time()
+        self.set_rules(())
+
+    def set_rules(self, rules):
+        """Index rules by _id (and * rules by an == predicate, if they have one)."""
+        self.rules = tuple(rules)
+        byid, anyid = collections.defaultdict(list), []
+        anyeq = collections.defaultdict(lambda: collections.defaultdict(list))
+        for rule in self.rules:
+            if '*' in rule.ids:
+                if rule.eq:
+                    anyeq[rule.eq[0]][rule.eq[1]].append(rule)
+                else:
+                    anyid.append(rule)
+            else:
+                for _id in rule.ids:
+                    byid[_id].append(rule)
+        self.anyid = tuple(anyid)
+        # An _id's rules include the unindexed * rules.
+        self.byid = dict((k, tuple(v) + self.anyid) for k, v in byid.items())
+        self.anyeq = tuple((key, dict((v, tuple(r)) for v, r in byvalue.items()))
+                           for key, byvalue in anyeq.items())
+
+    def evaluate(self, d, now=None):
+        """Check a record (its dict) against the rules for its _id."""
+        now = now or time.time()
+        if (now - self.pruned) > PRUNE:
+            with self.lock:
+                for rule in self.rules:
+                    rule.prune(now)
+            self.pruned = now
+        _id = _str(d.get('_id', '____'))
+        self.check(self.byid.get(_id, self.anyid), _id, d, now)
+        for key, byvalue in self.anyeq:
+            rules = byvalue.get(_str(d.get(key)))
+            if rules:
+                self.check(rules, _id, d, now)
+
+    def check(self, rules, _id, d, now):
+        for rule in rules:
+            if not rule.match(d):
+                continue
+            with self.lock:
+                fire = rule.hit(_id, now)
+            if fire:
+                self.fire(rule, _id, d, now)
+
+    def fire(self, rule, _id, d, now):
+        alert = {'rule': rule.name, '_id': _id, 'count': rule.count, 'window': rule.window,
+                 'ts': now, 'rec': d}
+        for action in rule.actions:
+            try:
+                action(alert)
+            except Exception as E:
+                self.log('alert %s: action: %s' % (rule.name, E))
+
+# Rules from an ini file -> AlertEngine.
+def load(pfn, emit=None, log=None):
+    cp = configparser.ConfigParser(inline_comment_prefixes=('#', ), interpolation=None)
+    with open(pfn, 'r', encoding=ENCODING, errors=ERRORS) as f:
+        cp.read_file(f)
+    engine = AlertEngine(emit=emit, log=log)
+    rules = []
+    for name in cp.sections():
+        sect = cp[name]
+        try:
+            ids = tuple(z.strip() for z in sect.get('id', '*').split(',') if z.strip())
+            predicates = tuple(compile_predicate(z) for z in sect.get('when', '').split(';') if z.strip())
+            actions = []
+            for z in sect.get('action', '').split('\n'):
+                z = z.strip()
+                if not z:
+                    continue
+                kind, _, arg = z.partition(':')
+                kind = kind.strip()
+                if kind not in ACTIONS:
+                    raise ValueError('unknown action: %r' % kind)
+                actions.append(ACTIONS[kind](arg.strip(), engine))
+            count = sect.getint('count', 1)
+            if count < 1:
+                raise ValueError('count < 1')
+            rules.append(Rule(name, ids, predicates,
+                              count=count,
+                              window=sect.getfloat('window', 0.0),
+                              cooldown=sect.getfloat('cooldown', 0.0),
+                              actions=tuple(actions)))
+        except ValueError as E:
+            raise ValueError('%s [%s]: %s' % (pfn, name, E))
+    engine.set_rules(rules)
+    return engine
@@ -0,0 +1,121 @@
+#> !P3!
+
+###
+### xdiag: xlog's own diagnostics, off the handler threads.
+###        - Callers only queue (put_nowait) a level, a category, a
+###          source (e.g., client IP) and an unformatted message: no
+###          formatting, no console I/O, no waiting.  A full queue
+###          drops (and counts) the message.
+###        - A thread formats and outputs, via a simple logger, at most
+###          a category's limit of messages per period.  The rest are
+###          counted, per (level, category, source), and summarized
+###          at the end of the period:
+###
+###            bad json dict x4312 from 10.0.0.7 in last 10s
+###
+###        - beeps() goes the same way (limit 1 per period, default).
+###
+
+import time, queue, threading, collections
+
+PERIOD = 10.0           # Secs per rate limiting period.
+LIMIT = 5               # Default messages per category per period.
+MAXQ = 10000            # Queue size.
+
+_STOP = object()
+
+class DiagLogger(object):
+
+    def __init__(self, sl, beeps=None, period=PERIOD, limit=LIMIT, limits=None, maxq=MAXQ):
+        self.sl = sl                        # Simple logger: .debug(), .info(), ...
+        self.beepf = beeps                  # f(n), or None.
+        self.period = period
+        self.limit = limit
+        self.limits = {'beeps': 1}          # Category -> limit.
+        self.limits.update(limits or {})
+        self.q = queue.Queue(maxq)
+        self.dropped = 0                    # Messages lost to a full queue.
+        self.thread = threading.Thread(target=self.run, name='xdiag')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, level, cat, src, fmt, args):
+        try:
+            self.q.put_nowait((level, cat, src, fmt, args))
+        except queue.Full:
+            self.dropped += 1
+
+    # fmt % args is only done for messages that are output.
+    def debug(self, cat, fmt='', *args, src=None):
+        self._put('debug', cat, src, fmt, args)
+
+    def info(self, cat, fmt='', *args, src=None):
+        self._put('info', cat, src, fmt, args)
+
+    def warning(self, cat, fmt='', *args, src=None):
+        self._put('warning', cat, src, fmt, args)
+
+    def error(self, cat, fmt='', *args, src=None):
+        self._put('error', cat, src, fmt, args)
+
+    def beeps(self, n, cat='beeps', src=None):
+        self._put('beeps', cat, src, n, ())
+
+    def close(self, timeout=5):
+        """Output what's queued and the pending summaries, then stop."""
+        try:
+            self.q.put(_STOP, timeout=timeout)
+            self.thread.join(timeout)
+        except queue.Full:
+            pass
+
+    def _emit(self, level, fmt, args):
+        if level == 'beeps':
+            if self.beepf:
+                self.beepf(fmt)
+            return
+        z = (fmt % args) if args else fmt
+        getattr(self.sl, level)(z)
+
+    def _summarize(self, suppressed, secs):
+        for (level, cat, src), n in sorted(suppressed.items(), key=lambda kn: -kn[1]):
+            if level == 'beeps':
+                continue
+            z = '%s x%d%s in last %ds' % (cat, n, (' from %s' % src) if src else '', round(secs))
+            getattr(self.sl, level)(z)
+        if self.dropped:
+            n, self.dropped = self.dropped, 0
+            self.sl.error('diagnostics queue full: %d messages dropped in last %ds' % (n, round(secs)))
+
+    def run(self):
+        t0 = time.time()
+        counts = collections.Counter()      # (level, cat) -> messages this period.
+        suppressed = collections.Counter()  # (level, cat, src) -> messages not output.
+        while True:
+            try:
+                item = self.q.get(timeout=0.5)
+            except queue.Empty:
+                item = None
+            now = time.time()
+            if item is _STOP or (now - t0) >= self.period:
+                try:
+                    self._summarize(suppressed, now - t0)
+                except Exception:
+                    pass
+                counts.clear()
+                suppressed.clear()
+                t0 = now
+                if item is _STOP:
+                    return
+            if item is None:
+                continue
+            level, cat, src, fmt, args = item
+            counts[(level, cat)] += 1
+            if counts[(level, cat)] <= self.limits.get(cat, self.limit):
+                try:
+                    self._emit(level, fmt, args)
+                except Exception as E:
+                    try:  self.sl.error('xdiag: %s: %s' % (cat, E))
+                    except:  pass
+            else:
+                suppressed[(level, cat, src)] += 1
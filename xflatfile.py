@@ -0,0 +1,76 @@
+#> !P3!
+
+###
+### xflatfile: Reading xlog flatfiles.
+###            - Parses FFV 0 ('|'), FFV 1 ('\t') and FFV 2 ('\t' +
+###              promoted columns) records into prefix tuples.
+###            - The json is left as a string; parse it only when
+###              needed (FFRec.data).
+###            - Flatfiles can be gzip'd, bzip2'd or xz'd (by suffix).
+###
+###  !!! SEE XLOG.PY FOR FLATFILE RECORD LAYOUTS !!!
+###
+
+import collections, json, gzip, bz2, lzma
+
+ENCODING    = 'utf-8'
+ERRORS      = 'strict'
+
+class FFRec(collections.namedtuple('FFRec', 'ffv rx tx id si el sl sha1 promoted js')):
+    """A flatfile record: prefix fields, promoted columns (a tuple) and the raw json."""
+    __slots__ = ()
+
+    @property
+    def data(self):
+        """The json contents string as a dict (parsed on each access)."""
+        return json.loads(self.js)
+
+# Parse one flatfile line (with or without its '\n').  Raises ValueError
+# on a malformed line.
+def parse(line):
+    line = line.rstrip('\r\n')
+    if line[:2] == '1\t':
+        a = line.split('\t', 8)
+        if len(a) != 9:
+            raise ValueError('bad FFV 1 record: %r' % line[:100])
+        return FFRec(a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7], (), a[8])
+    if line[:2] == '2\t':
+        # json.dumps(ensure_ascii=True) never emits a raw tab, so the json is
+        # always the last field, however many promoted columns there are.
+        head, js = line.rsplit('\t', 1)
+        a = head.split('\t')
+        if len(a) < 8:
+            raise ValueError('bad FFV 2 record: %r' % line[:100])
+        return FFRec(a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7], tuple(a[8:]), js)
+    a = line.split('|', 7)
+    if len(a) != 8 or len(a[0]) != 15:
+        raise ValueError('bad FFV 0 record: %r' % line[:100])
+    return FFRec('0', a[0], a[1], a[2], a[3], a[4], a[5], a[6], (), a[7])
+
+# Lazily yield FFRec's from an iterable of lines (e.g., an open file).
+# Blank lines are skipped.  Malformed lines are skipped unless strict.
+def records(lines, strict=False):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield parse(line)
+        except ValueError:
+            if strict:
+                raise
+
+# Open a flatfile for reading text, decompressing by suffix.
+def open_flatfile(pfn):
+    if pfn.endswith('.gz'):
+        return gzip.open(pfn, 'rt', encoding=ENCODING, errors=ERRORS)
+    if pfn.endswith('.bz2'):
+        return bz2.open(pfn, 'rt', encoding=ENCODING, errors=ERRORS)
+    if pfn.endswith('.xz'):
+        return lzma.open(pfn, 'rt', encoding=ENCODING, errors=ERRORS)
+    return open(pfn, 'r', encoding=ENCODING, errors=ERRORS)
+
+# Lazily yield FFRec's from a flatfile.
+def iter_records(pfn, strict=False):
+    with open_flatfile(pfn) as f:
+        for rec in records(f, strict=strict):
+            yield rec
@@ -0,0 +1,165 @@
+#> !P3!
+
+"""
+xfollow: Follow xlog's rolling flatfiles, resuming from a checkpoint.
+
+Usage:
+  xfollow.py --log_path=<log_path> --ckpt=<ckpt> [--json --once]
+  xfollow.py (-h | --help | --version)
+
+Options:
+  -h --help              Show help.
+  --version              Show version.
+  --log_path=<log_path>  xlog's --log_path (with its ~ymd~ etc.).
+  --ckpt=<ckpt>          Checkpoint pfn (created if need be).
+  --json                 Output only the json contents strings.
+  --once                 Stop at the end of the newest flatfile.
+"""
+
+###
+### xfollow: - Follower: tracks the flatfiles named by xlog's LOG_PATH
+###            template, in roll order, and yields their lines (or
+###            FFRec's, see xflatfile) as they're written.
+###          - Reads in large chunks; only complete lines are yielded.
+###          - The position (flatfile pfn + byte offset just past the
+###            last yielded line) is checkpointed durably (write, fsync,
+###            rename) after each chunk, on each roll and on request.
+###            A restarted Follower resumes there: lines yielded before
+###            the last checkpoint aren't seen again.
+###          - A roll is taken only after the newer flatfile exists and
+###            the older one has been read to its end.  (LFT closes the
+###            old flatfile before opening the new.)
+###
+
+import os, re, glob, json, time
+
+import xflatfile as _ff
+
+ENCODING    = 'utf-8'
+ERRORS      = 'strict'
+
+CHUNK = 1 << 20         # Bytes per read.
+POLL = 1.0              # Secs between looks for more, when caught up.
+
+# LOG_PATH template -> glob pattern.  (~me~, ~ymd~, ~h~, ... -> *)
+def log_glob(log_path):
+    return re.sub(r'~[a-z]+~', '*', log_path)
+
+class Follower(object):
+
+    def __init__(self, log_path, ckpt_pfn, chunk=CHUNK, poll=POLL):
+        self.pattern = log_glob(log_path)
+        self.ckpt_pfn = ckpt_pfn
+        self.chunk = chunk
+        self.poll = poll
+        self.pfn = None         # Current flatfile.
+        self.offset = 0         # Byte offset just past the last yielded line.
+        self.saved = None       # Last checkpointed (pfn, offset).
+        if os.path.isfile(ckpt_pfn):
+            with open(ckpt_pfn, 'r', encoding=ENCODING, errors=ERRORS) as f:
+                ckpt = json.load(f)
+            self.pfn, self.offset = ckpt['pfn'], ckpt['offset']
+            self.saved = (self.pfn, self.offset)
+
+    # Flatfiles, in roll order (zero-padded date/time names sort lexically).
+    def files(self):
+        return sorted(pfn for pfn in glob.glob(self.pattern) if not pfn.endswith('.cols'))
+
+    # The flatfile after pfn, or None.
+    def next_file(self, pfn):
+        for z in self.files():
+            if z > pfn:
+                return z
+        return None
+
+    def checkpoint(self):
+        """Durably record the current position."""
+        if self.pfn is None or self.saved == (self.pfn, self.offset):
+            return
+        tmp = self.ckpt_pfn + '.tmp'
+        with open(tmp, 'w', encoding=ENCODING, errors=ERRORS) as f:
+            json.dump({'pfn': self.pfn, 'offset': self.offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ckpt_pfn)
+        try:
+            # The rename itself, too.
+            fd = os.open(os.path.dirname(os.path.abspath(self.ckpt_pfn)), os.O_RDONLY)
+            try:  os.fsync(fd)
+            finally:  os.close(fd)
+        except OSError:
+            pass            # E.g., Windows: directories can't be opened.
+        self.saved = (self.pfn, self.offset)
+
+    def lines(self, follow=True):
+        """Yield complete flatfile lines (str, without '\\n'), forever if follow."""
+        while True:
+            # Where to (re)start.
+            if self.pfn is None or not os.path.isfile(self.pfn):
+                z = self.next_file(self.pfn or '')
+                if z is None:
+                    if not follow:
+                        return
+                    time.sleep(self.poll)
+                    continue
+                if self.pfn is not None:
+                    # The checkpointed flatfile is gone (e.g., archived): go on from the next.
+                    self.offset = 0
+                self.pfn = z
+                self.checkpoint()
+            with open(self.pfn, 'rb') as f:
+                f.seek(self.offset)
+                tail = b''
+                while True:
+                    # Is there a newer flatfile?  Look before reading, so the
+                    # read that follows is known to reach the old one's end.
+                    newer = self.next_file(self.pfn)
+                    data = f.read(self.chunk)
+                    if data:
+                        data = tail + data
+                        j = data.rfind(b'\n')
+                        if j < 0:
+                            tail = data
+                            continue
+                        tail = data[j+1:]
+                        for line in data[:j].split(b'\n'):
+                            self.offset += len(line) + 1
+                            line = line.rstrip(b'\r')
+                            if line:
+                                yield line.decode(encoding=ENCODING, errors=ERRORS)
+                        self.checkpoint()
+                        continue
+                    # At the end.
+                    if newer:
+                        # Rolled.  (An unterminated last line is dropped.)
+                        self.pfn, self.offset = newer, 0
+                        self.checkpoint()
+                        break
+                    if not follow:
+                        self.checkpoint()
+                        return
+                    time.sleep(self.poll)
+
+    def records(self, follow=True):
+        """Yield FFRec's (prefix fields parsed, json not).  Malformed lines are skipped."""
+        return _ff.records(self.lines(follow=follow))
+
+if __name__ == '__main__':
+
+    import sys
+    import docopt
+
+    ARGS = docopt.docopt(__doc__, version='0.1')
+    follower = Follower(ARGS['--log_path'], ARGS['--ckpt'])
+    try:
+        if ARGS['--json']:
+            for rec in follower.records(follow=not ARGS['--once']):
+                sys.stdout.write(rec.js + '\n')
+        else:
+            for line in follower.lines(follow=not ARGS['--once']):
+                sys.stdout.write(line + '\n')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout.flush()
+        follower.checkpoint()
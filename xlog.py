@@ -62,6 +62,11 @@ Options:
 ###
 ###         (_id, _si, _el, _sl default to '_' chars)
 ###
+###   A client can send '!HELLO {...}!' first: a json'd dict of
+###   defaults for _id, _si, _el, _sl and any static keys.  Its
+###   records can then omit them: xlog puts them back (a record's own
+###   keys win), so the flatfile json and SHA1 are as if sent.
+###
 ###  All keys remain in the KV lump for downstreamers.
 ###
 
@@ -139,10 +144,29 @@ Options:
 ### 1_rrrrrrrrrrrrrrr_ttttttttttttttt_IIII_iiii_E_e_ssssssssssssssssssssssssssssssssssssssss_{...}
 ### ....:....1....:....2....:....3....:....4....:....5....:....6....:....7....:....8....:....9....:....A
 ###
+### PROMOTED version (explicitly FFV 2), using \t delimiters.
+###
+###   As FFV 1, but with NP extra columns between the SHA1 and the
+###   contents string.  NP is the largest number of keys promoted
+###   for any one _id (see --promote).  Each column holds the value
+###   of a promoted key (str as-is, others json'd, tabs and newlines
+###   blanked), or is empty when the key is absent or the record's
+###   _id has fewer promoted keys.
+###
+###   --promote = nx01:status,remote_addr; st01:sid
+###
+### 2_rrrrrrrrrrrrrrr_ttttttttttttttt_IIII_iiii_E_e_ssssssssssssssssssssssssssssssssssssssss_p1_..._pNP_{...}
+###
+###   Which key is in which column, per _id, is recorded in a column
+###   manifest next to each flatfile (<log pfn>.cols).  It holds one
+###   json line per distinct layout, with the byte offset in the
+###   flatfile from which that layout applies.  Consumers can then
+###   filter with line.split('\t', 8 + NP) instead of json.loads.
+###
 
 import os, sys, stat, time, datetime, calendar
 import shutil, collections, pickle, copy, json
-import queue, threading, hashlib, importlib
+import queue, threading, hashlib, importlib, socket, re
 from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
 
 gP2 = (sys.version_info[0] == 2)
@@ -178,6 +202,27 @@ _sl = l_simple_logger.SimpleLogger(screen_writer=_sw)
 import l_args as _a             # INI + command line args.
 ME = _a.get_args(__doc__, '0.1')
 
+import xflatfile as _ff         # Flatfile record parsing.
+
+# Per-record diagnostics (bad records, connects, ...): queued, rate limited per
+# category, summarized per period.  See xdiag.py.
+#   --diag_period = Secs (default 10).
+#   --diag_limit  = Messages per category per period (default 5).
+#   --diag_limits = Per category, e.g. connect:2; bad json dict:20
+def parse_limits(z):
+    limits = {}
+    for spec in (z or '').split(';'):
+        if spec.strip():
+            cat, n = spec.rsplit(':', 1)
+            limits[cat.strip()] = int(n)
+    return limits
+
+import xdiag
+_dl = xdiag.DiagLogger(_sl, beeps=_m.beeps,
+                       period=float(_a.ARGS.get('--diag_period') or xdiag.PERIOD),
+                       limit=int(_a.ARGS.get('--diag_limit') or xdiag.LIMIT),
+                       limits=parse_limits(_a.ARGS.get('--diag_limits')))
+
 HOST     = _a.ARGS['--host']
 IPPFX    = _a.ARGS['--ippfx']
 PORT     = int(_a.ARGS['--port'])
@@ -196,12 +241,40 @@ else:
     VIEWER = VM = None
     _sl.info('not VERBOSE')
 
+# Optional SQLite sink (per-day database, same ~ymd~ etc. as LOG_PATH).
+SQLITE_PATH  = _a.ARGS.get('--sqlite_path')
+SQLITE_BATCH = int(_a.ARGS.get('--sqlite_batch') or 1000)
+if SQLITE_PATH:
+    import xsqlite
+
 ENCODING    = 'utf-8'             
 ERRORS      = 'strict'
 
 _ = '\t'    # Tab is the new | (separator for fields in prefix).
 FFV = '1'   # Flatfile version (151101: Version added, _si added, '\t' instead of '|').
 
+# Promoted columns.  '_id:key,key; _id:key' -> {_id: [key, ...]}
+def parse_promote(z):
+    promote = collections.OrderedDict()
+    if not z:
+        return promote
+    for spec in z.split(';'):
+        spec = spec.strip()
+        if not spec:
+            continue
+        try:
+            id, keys = spec.split(':', 1)
+        except ValueError:
+            errmsg = 'bad --promote spec: %r' % spec
+            raise ValueError(errmsg)
+        promote[id.strip()] = [k.strip() for k in keys.split(',') if k.strip()]
+    return promote
+
+PROMOTE  = parse_promote(_a.ARGS.get('--promote'))
+NPROMOTE = max([len(keys) for keys in PROMOTE.values()] or [0])
+if NPROMOTE:
+    FFV = '2'   # 2: FFV 1 + NPROMOTE promoted columns before the json.
+
 ####################################################################################################
 
 # TimeStamp, serialized.
@@ -276,12 +349,39 @@ def log_open():
     if not os.path.isdir(p):
         os.makedirs(p)
     LOG_FILE = open(LOG_PFN, 'a', encoding=ENCODING, errors=ERRORS, buffering=1)  # 1 -> line buffering, obviating flushing.
+    if NPROMOTE:
+        log_manifest()
+
+# Column manifest for FFV 2 flatfiles: <log pfn>.cols, one json line
+# per layout, appended only when the layout differs from the last one.
+def log_manifest():
+    mpfn = LOG_PFN + '.cols'
+    columns = ['ffv', 'rx', 'tx', '_id', '_si', '_el', '_sl', 'sha1'] + \
+              ['p%d' % (x+1) for x in range(NPROMOTE)] + ['json']
+    last = None
+    if os.path.isfile(mpfn):
+        with open(mpfn, 'r', encoding=ENCODING, errors=ERRORS) as f:
+            for line in f:
+                if line.strip():
+                    last = line
+    if last:
+        last = json.loads(last)
+        if last.get('columns') == columns and last.get('promote') == PROMOTE:
+            return
+    manifest = collections.OrderedDict()
+    manifest['offset'] = LOG_FILE.tell()
+    manifest['ffv'] = FFV
+    manifest['columns'] = columns
+    manifest['promote'] = PROMOTE
+    with open(mpfn, 'a', encoding=ENCODING, errors=ERRORS) as f:
+        f.write(json.dumps(manifest, ensure_ascii=True) + '\n')
 
 # Build a log file path+fn using local time (for time and date rolling).
-def current_log_pfn():
-    if not LOG_PATH:
+# Also used for other rolling outputs (e.g., SQLITE_PATH) via template.
+def current_log_pfn(template=None):
+    z = template or LOG_PATH
+    if not z:
         return None
-    z = LOG_PATH
     z = z.replace('~me~',   ME)
     # Use LOCal time.
     z = z.replace('~y~',    LOC_YMD[:2])
@@ -300,11 +400,71 @@ LFQ = None              # Log File Queue (to output thread).
 LFT = None              # Log File Thread.
 LFTSTOP = None          # Log File Thread signal to STOP.
 LFTSTOPPED = None       # Log File Thread has responded to LFTSTOP.
-
-def reformatLogrec(logrec):
+SQLITE = None           # SQLite sink (owned by LFT).
+
+# A promoted value as a prefix column: str as-is, others json'd, no tabs or newlines.
+def promoted_value(v):
+    if v is None:
+        return ''
+    if not isinstance(v, str):
+        v = json.dumps(v, ensure_ascii=True, sort_keys=True)
+    return v.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+# The NPROMOTE promoted columns for a record of _id (padded with '').
+def promoted_cols(_id, logdict):
+    keys = PROMOTE.get(_id, ())
+    return [promoted_value(logdict.get(k)) for k in keys] + [''] * (NPROMOTE - len(keys))
+
+# A parsed flatfile record (an FFRec, e.g. relayed from another xlog with
+# another FFV or --promote) as a line in this xlog's layout.
+def render_rec(rec):
+    pfx = _.join((rec.rx, rec.tx, rec.id, rec.si, rec.el, rec.sl, rec.sha1))
+    if NPROMOTE:
+        return FFV + _ + pfx + _ + _.join(promoted_cols(rec.id, rec.data)) + _ + rec.js + '\n'
+    return FFV + _ + pfx + _ + rec.js + '\n'
+
+# Prefix fields as str's: int's converted, '_' defaults.
+def prefix_fields(d):
+    _id, _si, _el, _sl = d.get('_id', '____'), d.get('_si', '____'), d.get('_el', '_'), d.get('_sl', '_')
+    # Convert int's to str's.
+    if isinstance(_id, int):
+        _id = '%04d' % _id
+    if isinstance(_si, int):
+        _si = '%04d' % _si
+    if isinstance(_el, int):
+        _el = '%d' % _el
+    if isinstance(_sl, int):
+        _sl = '%d' % _sl
+    return (_id, _si, _el, _sl)
+
+PREFIX_KEYS = frozenset(('_id', '_si', '_el', '_sl'))
+
+class Hello(object):
+    """Per-connection record defaults, from '!HELLO {...}!'."""
+
+    def __init__(self, js):
+        d = json.loads(js)
+        if not isinstance(d, dict):
+            raise ValueError('not a json dict')
+        for k in ('_ip', '_ts'):
+            if k in d:
+                raise ValueError('%s can\'t be defaulted' % k)
+        for k in PREFIX_KEYS.intersection(d):
+            if isinstance(d[k], bool) or not isinstance(d[k], (str, int)):
+                raise ValueError('%s must be a str or int' % k)
+        self.defaults = d
+        # For records with none of the PREFIX_KEYS of their own, the
+        # prefix fields are the same every time: render them once.
+        self._id, _si, _el, _sl = prefix_fields(d)
+        self.pfx = _.join((self._id, _si, _el, _sl))
+
+def reformatLogrec(payload, _ip, alerts=True, hello=None):
     """Add a prefix to a sorted source logrec."""
     #
-    #  In: 0.0.0.0|{...json dict payload...} 
+    #  In: payload: b'{...json dict payload...}' (bytes, as received)
+    #      _ip:     '0.0.0.0' (the client's IP, from the connection)
+    #      alerts:  False for records made by alerts (no re-evaluating them)
+    #      hello:   The connection's Hello, or None
     # Out: (rc, rm, newrec)
     #   rc: True (OK), False
     #   rm: 'OK' or errmsg
@@ -313,55 +473,49 @@ def reformatLogrec(logrec):
     #                    Added FFV.
     #       timestamps, defaults, SHA1 and sorted json dict into a flatfile record:
     #       '%s|%s|%s|%s|%s|%s|%s|%s|%s|%s\n' %(FFV, UTC_TS_STR, _ts, _id, _si, _sl, _el, _sl, sha1x, jslda)
+    #       FFV 2 adds NPROMOTE promoted columns between sha1x and jslda.
     #       
     me = 'reformatLogrec'
     rc, rm, newrec = False, '???', None
     try:
-        # logrec: tx-ip|payload.
-        try:
-            _ip, payload = logrec.split(_, 1)
-        except Exceptions as E:
-            errmsg = 'split _ip|payload: %s' % E
-            _sl.error(errmsg)#$#
-            rc, rm, = False, errmsg
-            # No exception.
-            return
         if not _ip or not _ip[0].isdigit() or not _ip[-1].isdigit() or _ip.count('.') != 3:
             errmsg = 'bad _ip: %r' % _ip
-            _sl.error(errmsg)#$#
+            _dl.error('bad _ip', errmsg, src=_ip)#$#
             rc, rm, = False, errmsg
             # No exception.
             return
-        if not payload or payload[0] != '{' or payload[-1] != '}':
-            errmsg = 'bad json dict: %r' % payload
-            _sl.error(errmsg)#$#
-            rc, rm, = False, errmsg
+        # Bad records are logged (once, with their head) by _dl, which
+        # formats only the ones it outputs.  The NAK doesn't echo them.
+        if payload[:1] != b'{' or payload[-1:] != b'}':
+            _dl.error('bad json dict', 'bad json dict: %r', payload[:HEADLEN], src=_ip)#$#
+            rc, rm, = False, 'bad json dict'
             # No exception.
             return
         try:
-            logdict = json.loads(payload)
+            logdict = json.loads(payload)       # Decodes the bytes itself.
         except Exception as E:
             errmsg = 'json.loads: %s' % E
-            _sl.error(errmsg)#$#
+            _dl.error('json.loads', 'json.loads: %s: %r', E, payload[:HEADLEN], src=_ip)#$#
             rc, rm, = False, errmsg
             # Swallow the exception.
             return
+        # Connection defaults?  (See !HELLO!.)  The record's own keys win.
+        if hello:
+            own = PREFIX_KEYS.intersection(logdict)
+            d = hello.defaults.copy()
+            d.update(logdict)
+            logdict = d
         # Inject the tx ip.
         logdict['_ip'] = _ip
         # Get a new realtime ts.
         update_ts()
         # Retrieve fields needed for the logrec prefix.  Supply '_' defaults.
-        _ts, _id, _si, _el, _sl = \
-            logdict.get('_ts'), logdict.get('_id', '____'), logdict.get('_si', '____'), logdict.get('_el', '_'), logdict.get('_sl', '_')
-        # Convert int's to str's.
-        if isinstance(_id, int):
-            _id = '%04d' % _id
-        if isinstance(_si, int):
-            _si = '%04d' % _si
-        if isinstance(_el, int):
-            _el = '%d' % _el
-        if isinstance(_sl, int):
-            _sl = '%d' % _sl
+        _ts = logdict.get('_ts')
+        if hello and not own:
+            _id, pfx = hello._id, hello.pfx
+        else:
+            _id, _si, _el, _sl = prefix_fields(logdict)
+            pfx = '%s%s%s%s%s%s%s' % (_id, _, _si, _, _el, _, _sl)
         # If the sender didn't supply a ts string, use the realtime one.
         if not _ts:
             _ts = UTC_TS_STR
@@ -374,35 +528,57 @@ def reformatLogrec(logrec):
         h.update(jsldab)
         sha1x = h.hexdigest()
         # A new logrec: a fat prefix + json'd sorted input dict.
-        newrec = '%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s\n' %(FFV, _, UTC_TS_STR, _, _ts, _, _id, _, _si, _, _el, _, _sl, _, sha1x, _, jslda)        
-        #                                                         |              | Optionally supplied by sender.
-        #                                                         |              | Defaults to UTC_TS_STR.               
-        #                                                         | Realtime xlog arrival ts.
+        newrec = '%s%s%s%s%s%s%s%s%s%s%s\n' %(FFV, _, UTC_TS_STR, _, _ts, _, pfx, _, sha1x, _, jslda)        
+        #                                             |              |        | _id _si _el _sl
+        #                                             |              | Optionally supplied by sender.
+        #                                             |              | Defaults to UTC_TS_STR.               
+        #                                             | Realtime xlog arrival ts.
+        # FFV 2: splice in the promoted columns (padded to NPROMOTE) ahead of the json.
+        if NPROMOTE:
+            newrec = newrec[:-(len(jslda) + 1)] + _.join(promoted_cols(_id, logdict)) + _ + jslda + '\n'
+        # Alert rules: evaluated by ALT.  (A full ALQ doesn't fail the record.)
+        if ALQ and alerts:
+            try:
+                ALQ.put_nowait(logdict)
+            except queue.Full:
+                _dl.error('alerts', 'alert queue full: record not evaluated', src=_id)
         rc, rm = True, 'OK'
     except Exception as E:
         errmsg = '%s: %s @ %s' % (me, E, _m.tblineno())
-        _sl.error(errmsg)#$#
+        _dl.error(me, '%s: %r', errmsg, payload[:HEADLEN], src=_ip)#$#
         rc, rm, = False, errmsg
         # Swallow the exception.
     finally:
         return (rc, rm, newrec)
 
+# A failed SQLite flush (the rows are kept, and retried): log it.
+def sqlite_error(E):
+    _dl.error('sqlite', 'sqlite: %s: %d rows pending, %d dropped', E, len(SQLITE.rows), SQLITE.dropped)
+
 def logFileThread():  
     """Consume LFQ, writing to the log file."""
     # Additionally, when VERBOSE, write to screen.
     # When VERBOSE, the log file can be null.
-    global CHK_UTC_TS, LOG_PFN, LFTSTOPPED
+    global CHK_UTC_TS, LOG_PFN, LFTSTOPPED, SQLITE
     me = 'LFT'
     # No thread-local vars bcs only one thread.
     _sl.extra(me + ' begins')
     try:          
         rplrc = 0           # Records per log roll check.
         wlpfn = None       # Working version of LOG_PFN.
+        sqchk = 0          # UTC TS of last SQLite commit/roll check.
+        if SQLITE_PATH:
+            SQLITE = xsqlite.SQLiteSink(batch=SQLITE_BATCH)
         while True:
             if LFTSTOP:
                 _sl.extra('STOPping')#$#
                 LFTSTOPPED = True
                 log_close()
+                if SQLITE:
+                    try:
+                        SQLITE.close()
+                    except Exception as E:
+                        _sl.error('%s: sqlite: %s: %d rows not stored' % (me, E, len(SQLITE.rows)))
                 return
             try:        
 
@@ -444,15 +620,37 @@ def logFileThread():
                 
                 # No log file?
                 else:
-                    if not VERBOSE:
+                    if not VERBOSE and not SQLITE:
                         raise ValueError('no LOG_FILE from: ' + LOG_PFN)
 
+                # SQLite?  (Via SQLITE_PATH.  Batched: a transaction per SQLITE_BATCH
+                # records, or less every 1-sec and when LFQ runs dry.)  Its errors
+                # are logged, never raised: the flatfile comes first.
+                if SQLITE:
+                    # Commit and roll check every 1-sec.
+                    if UTC_TS > (sqchk + 1):
+                        sqchk = UTC_TS
+                        try:
+                            SQLITE.flush()
+                            SQLITE.roll(current_log_pfn(SQLITE_PATH))
+                        except Exception as E:
+                            sqlite_error(E)
+                    try:
+                        SQLITE.add(logrec)
+                    except Exception as E:
+                        sqlite_error(E)
+
+                # Relay?  (Via RELAY_HP.  RLT batches and sends.)
+                if RLQ:
+                    RLQ.put(logrec)
+
                 # VERBOSE? (Custom output to screen.)
                 if VERBOSE:
                     try:    
-                        a = logrec.split(_, 9)
-                        ffv = a.pop(0)
-                        b = json.loads(a.pop(-1))
+                        # Prefix fields (and any promoted columns) and the json.
+                        rec = _ff.parse(logrec)
+                        a = list(rec[1:8]) + list(rec.promoted)
+                        b = rec.data
                         b['sl'] = _sl
                         ###
                         id, si, el, sl, msg = b['_id'], b['_si'], b['_el'], b['_sl'], b.get('_msg', 'None')
@@ -465,7 +663,12 @@ def logFileThread():
                         print('!! ' + logrec + ' !! ' + errmsg + ' !!')
 
             except queue.Empty:
-                pass
+                # Idle: commit what's pending.
+                if SQLITE:
+                    try:
+                        SQLITE.flush()
+                    except Exception as E:
+                        sqlite_error(E)
     except Exception as E:
         errmsg = '%s: %s @ %s' % (me, E, _m.tblineno()) + '\n' + \
                  '%s: LR: %s' % (me, repr(logrec))
@@ -477,13 +680,351 @@ def logFileThread():
 def startLogFileThread():
     global LFQ, LFT
     LFQ = queue.Queue()
-    LFT = threading.Thread(target=logFileThread)
+    LFT = threading.Thread(target=logFileThread, name='LFT')
     LFT.daemon = True
     LFT.start()
     # The rolling log file name and the file object are maintained by LFT.
 
 ####################################################################################################
 
+# Alerts: rules (see xalert.py) from an ini file.  reformatLogrec queues
+# each record's dict to ALQ, and ALT evaluates the rules and runs their
+# actions, so handler threads (and their ACKs) never wait on them.
+#
+#   --alert_ini = Rules pfn.
+#   --alert_id  = _id of the records made by the 'record' action
+#                 (default 'xalr').  Their _si is the alerting _id.
+#   --alert_q   = ALQ size (default 10000).  Records beyond it aren't
+#                 evaluated (and are logged).
+
+ALERT_INI = _a.ARGS.get('--alert_ini')
+ALERT_ID  = _a.ARGS.get('--alert_id') or 'xalr'
+ALERT_Q   = int(_a.ARGS.get('--alert_q') or 10000)
+
+ALQ = None              # Alert Queue (records' dicts, to ALT).
+ALT = None              # Alert Thread.
+
+# The 'record' alert action: a record from self (0.0.0.0) to LFT.
+def alert_record(alert):
+    d = collections.OrderedDict()
+    d['_id'] = ALERT_ID
+    d['_si'] = alert['_id']
+    d['_el'] = 4
+    d['_sl'] = 'A'
+    d['_msg'] = 'alert %s: %d in %gs from %s' % (alert['rule'], alert['count'], alert['window'], alert['_id'])
+    d['alert'] = dict((k, v) for k, v in alert.items() if k != 'rec')
+    z = json.dumps(d, ensure_ascii=True)
+    (rc, rm, newrec) = reformatLogrec(z.encode(encoding=ENCODING, errors=ERRORS), '0.0.0.0', alerts=False)
+    if rc:
+        LFQ.put(newrec)
+
+def alertThread():
+    """Consume ALQ, evaluating the alert rules."""
+    me = 'ALT'
+    _sl.extra(me + ' begins')
+    while True:
+        logdict = ALQ.get()
+        try:
+            ALERTS.evaluate(logdict)
+        except Exception as E:
+            _dl.error('alerts', 'alerts: %s @ %s', E, _m.tblineno())
+        finally:
+            ALQ.task_done()
+
+def startAlertThread():
+    global ALQ, ALT
+    ALQ = queue.Queue(ALERT_Q)
+    ALT = threading.Thread(target=alertThread, name='ALT')
+    ALT.daemon = True
+    ALT.start()
+
+if ALERT_INI:
+    import xalert
+    ALERTS = xalert.load(ALERT_INI, emit=alert_record, log=lambda z: _dl.error('alerts', z))
+    _sl.info('%d alert rules from %s' % (len(ALERTS.rules), ALERT_INI))
+else:
+    ALERTS = None
+
+####################################################################################################
+
+# Relay: forward flatfile records, as written (rx TS, SHA1 etc. intact),
+# to an upstream xlog, which queues them to its LFT as-is.
+#
+#   --relay        = host:port of the upstream xlog.
+#   --relay_batch  = Records per batch (default 500).
+#   --relay_window = Batches sent but not yet ACK'd (default 8).
+#   --relay_buffer = Records held here while upstream is unreachable
+#                    (default 100000).  Beyond that the oldest are
+#                    dropped (and counted).
+#
+# Upstream:
+#
+#   --relay_accept  = IPs allowed to relay to this xlog, ','-separated.
+#                     Ones ending in '.' are prefixes (as --ippfx), e.g.
+#                     127.0.0.1, 192.168.100.  Default: none.
+#   --relay_max_rec = Max relayed line bytes (default 4 * --max_rec: a
+#                     flatfile line is longer than the record it came
+#                     from).  --spill_rec doesn't apply.
+#
+# On the wire: '!RELAY n!\n' then n flatfile lines.  Upstream replies
+# 'OK|!RELAY n!|k bad' once the batch is on its LFQ, or 'E: ...' (e.g.,
+# not accepted).  Bad records (malformed, SHA1 mismatch, too long) are
+# lost: counted and logged at both ends.  Batches are pipelined: up to
+# RELAY_WINDOW are in flight over one persistent connection, their ACKs
+# matched in order.  After a reconnect, unACK'd batches are resent, so
+# upstream can see a batch twice (with the same rx TS and SHA1).
+#
+# Upstream rewrites relayed records in its own layout (FFV, promoted
+# columns), but keeps their rx TS: its flatfiles are then NOT in rx
+# order (relayed records arrive late, and resends later still).  Sort
+# them before using them where order matters (e.g., xmerge).
+
+RELAY_HP     = _a.ARGS.get('--relay')
+if RELAY_HP:
+    RELAY_HP = (RELAY_HP.split(':')[0], int(RELAY_HP.split(':')[1]))
+RELAY_BATCH  = int(_a.ARGS.get('--relay_batch') or 500)
+RELAY_WINDOW = int(_a.ARGS.get('--relay_window') or 8)
+RELAY_BUFFER = int(_a.ARGS.get('--relay_buffer') or 100000)
+RELAY_RETRY  = 5        # Secs between connection attempts.
+RELAY_ACCEPT = tuple(z.strip() for z in (_a.ARGS.get('--relay_accept') or '').split(',') if z.strip())
+RELAY_MAX_REC = int(_a.ARGS.get('--relay_max_rec') or 0) or None
+RELAY_ACK = re.compile(r'^OK\|!RELAY (\d+)!\|(\d+) bad$')
+
+RLQ = None              # Relay Queue (from LFT).
+RLT = None              # Relay Thread.
+RLTSTOP = None          # Relay Thread signal to STOP.
+RLBUSY = 0              # Records held by RLT (pending + unACK'd).
+RLSTATS = collections.Counter()     # relayed, lost, rejected, dropped, reconnects.
+
+def relayThread():
+    """Consume RLQ, forwarding batches to RELAY_HP."""
+    global RLBUSY
+    me = 'RLT'
+    _sl.extra(me + ' begins')
+    pending = collections.deque()   # Records not yet sent.
+    unacked = collections.deque()   # Batches (lists of records) sent, not yet ACK'd.
+    skt = lr = None
+    retry = 0                       # Time of next connection attempt.
+    try:
+        while not RLTSTOP:
+
+            # Buffer locally: block for the first record only when idle.
+            try:
+                block = not pending and not unacked
+                while True:
+                    pending.append(RLQ.get(block=block, timeout=1))
+                    block = False
+            except queue.Empty:
+                pass
+            while len(pending) > RELAY_BUFFER:
+                pending.popleft()
+                RLSTATS['dropped'] += 1
+            RLBUSY = len(pending) + sum(len(batch) for batch in unacked)
+            if not pending and not unacked:
+                continue
+
+            # Ensure a connection.
+            if not skt:
+                if time.time() < retry:
+                    time.sleep(0.2)
+                    continue
+                try:
+                    skt = socket.create_connection(RELAY_HP, timeout=10)
+                    skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    lr = LineReader(skt)
+                    _sl.info('%s: connected to %r' % (me, RELAY_HP))
+                except OSError as E:
+                    _sl.warning('%s: connect %r: %s' % (me, RELAY_HP, E))
+                    skt = lr = None
+                    retry = time.time() + RELAY_RETRY
+                    continue
+
+            try:
+                # Send, while the window has room.
+                skt.settimeout(10)
+                while pending and len(unacked) < RELAY_WINDOW:
+                    batch = [pending.popleft() for x in range(min(RELAY_BATCH, len(pending)))]
+                    unacked.append(batch)
+                    z = '!RELAY %d!\n%s\n' % (len(batch), '\n'.join(batch))
+                    skt.sendall(z.encode(encoding=ENCODING, errors=ERRORS))
+                # ACKs: wait a while only for a full window (or the last batches).
+                skt.settimeout(1 if (len(unacked) >= RELAY_WINDOW or not pending) else 0.001)
+                while unacked:
+                    try:
+                        ack = lr.readline()
+                    except socket.timeout:
+                        break
+                    if ack is None:
+                        raise ConnectionResetError('upstream closed connection')
+                    batch = unacked.popleft()
+                    ack = ack.decode(encoding=ENCODING, errors='replace')
+                    m = RELAY_ACK.match(ack)
+                    if m and int(m.group(1)) == len(batch):
+                        bad = int(m.group(2))
+                        RLSTATS['relayed'] += len(batch) - bad
+                        if bad:
+                            RLSTATS['lost'] += bad
+                            _sl.error('%s: %d of %d records bad upstream (lost)' % (me, bad, len(batch)))
+                    else:
+                        RLSTATS['rejected'] += len(batch)
+                        _sl.error('%s: %d records rejected: %s' % (me, len(batch), ack))
+            except OSError as E:
+                _sl.warning('%s: %r: %s' % (me, RELAY_HP, E))
+                try:  skt.close()
+                except:  pass
+                skt = lr = None
+                # Resend the unACK'd, in order, ahead of the rest.
+                while unacked:
+                    pending.extendleft(reversed(unacked.pop()))
+                RLSTATS['reconnects'] += 1
+                retry = time.time() + RELAY_RETRY
+
+        _sl.extra('STOPping')#$#
+        lost = len(pending) + sum(len(batch) for batch in unacked)
+        if lost:
+            _sl.error('%s: %d records not relayed' % (me, lost))
+    except Exception as E:
+        errmsg = '%s: %s @ %s' % (me, E, _m.tblineno())
+        DOSQUAWK(errmsg)
+        raise
+    finally:
+        if skt:
+            try:  skt.close()
+            except:  pass
+        _sl.extra('%s ends: %r' % (me, dict(RLSTATS)))
+
+def startRelayThread():
+    global RLQ, RLT
+    RLQ = queue.Queue()
+    RLT = threading.Thread(target=relayThread, name='RLT')
+    RLT.daemon = True
+    RLT.start()
+
+def relay_accepted(_ip):
+    for z in RELAY_ACCEPT:
+        if _ip == z or (z.endswith('.') and _ip.startswith(z)):
+            return True
+    return False
+
+# Upstream side: accept a '!RELAY n!' batch of n flatfile records.
+# They're queued to LFT as received (not re-stamped, but in this xlog's
+# layout), after their SHA1 is checked.  Returns the ACK (or NAK).
+def relay_rx(lr, rx, _ip):
+    try:
+        n = int(rx[len('!RELAY '):-1])
+        if n < 0:
+            raise ValueError
+    except ValueError:
+        # (What follows, if anything, will be NAK'd as records.)
+        return 'E: %s: bad count' % rx
+    accept = relay_accepted(_ip)
+    bad = 0
+    # Relayed lines: their own limit, no spilling.
+    maxrec, spill = lr.maxrec, lr.spill
+    lr.maxrec, lr.spill = RELAY_MAX_REC or 4 * MAX_REC, None
+    try:
+        for x in range(n):
+            frame = lr.readline()
+            if frame is None:
+                raise EOFError('relay batch truncated')
+            if not accept:
+                continue                # Read, to stay in step.
+            if not isinstance(frame, bytes):
+                if isinstance(frame, Spilled):
+                    unblob(frame)
+                bad += 1                # Oversize.
+                continue
+            try:
+                rec = _ff.parse(frame.decode(encoding=ENCODING, errors=ERRORS))
+                if hashlib.sha1(rec.js.encode(encoding=ENCODING, errors=ERRORS)).hexdigest() != rec.sha1:
+                    raise ValueError('SHA1 mismatch')
+                line = render_rec(rec)
+            except ValueError as E:
+                bad += 1
+                continue
+            LFQ.put(line)
+    finally:
+        lr.maxrec, lr.spill = maxrec, spill
+    if not accept:
+        _dl.error('relay', 'relay: %d records from %s refused (not in --relay_accept)', n, _ip, src=_ip)
+        return 'E: %s: not accepted from %s' % (rx, _ip)
+    if bad:
+        _dl.error('relay', 'relay: %d of %d bad records (lost)', bad, n, src=_ip)
+    return 'OK|%s|%d bad' % (rx, bad)
+
+####################################################################################################
+
+# On-demand profiling, via control lines from a client:
+#
+#   !PROF START!   Start the sampling profiler (handler threads and LFT).
+#   !PROF STOP!    Stop it, write its report next to the flatfiles.
+#   !MEM START!    Start tracemalloc.
+#   !MEM SNAP!     Snapshot (diffed against the previous one), write its report.
+#   !MEM STOP!     Stop tracemalloc.
+#
+# The reply is 'OK|<command>|<one-line summary>'.
+
+import xprof
+
+PROF_INTERVAL = float(_a.ARGS.get('--prof_interval') or 0.005)    # Secs between samples.
+PROF_MAXSECS  = float(_a.ARGS.get('--prof_maxsecs') or 600)       # Sampler stops itself after this.
+
+PROFLOCK = threading.Lock()
+PROFILER = None             # Current xprof.Sampler.
+
+# The threads profiled: the handlers (see Handler.handle) and LFT.
+def prof_select(name):
+    return name == 'LFT' or name.startswith('handler')
+MEMTRACER = xprof.MemTracer()
+
+# Write a report next to the flatfiles (or to cwd without LOG_PATH).
+def prof_write(kind, report):
+    p = os.path.dirname(LOG_PFN or current_log_pfn() or '') or '.'
+    if not os.path.isdir(p):
+        os.makedirs(p)
+    pfn = os.path.join(p, '%s-%s-%s-%s.txt' % (ME, kind, LOC_YMD, LOC_HMS))
+    n = 1
+    while os.path.exists(pfn):     # Several in the same second.
+        n += 1
+        pfn = os.path.join(p, '%s-%s-%s-%s-%d.txt' % (ME, kind, LOC_YMD, LOC_HMS, n))
+    with open(pfn, 'w', encoding=ENCODING, errors=ERRORS) as f:
+        f.write(report)
+    return pfn
+
+def prof_command(rx):
+    """Do a !PROF ...! or !MEM ...! command.  Returns a summary.  Raises ValueError."""
+    global PROFILER
+    with PROFLOCK:
+        update_ts()
+        if   rx == '!PROF START!':
+            if PROFILER and PROFILER.is_alive():
+                raise ValueError('already profiling')
+            PROFILER = xprof.Sampler(interval=PROF_INTERVAL, maxsecs=PROF_MAXSECS, select=prof_select)
+            PROFILER.start()
+            return 'sampling every %g secs for at most %g secs' % (PROF_INTERVAL, PROF_MAXSECS)
+        elif rx == '!PROF STOP!':
+            if not PROFILER:
+                raise ValueError('not profiling')
+            PROFILER.stop()
+            pfn = prof_write('prof', PROFILER.report())
+            summary = PROFILER.summary()
+            PROFILER = None
+            return '%s -> %s' % (summary, pfn)
+        elif rx == '!MEM START!':
+            MEMTRACER.start()
+            return 'tracemalloc started'
+        elif rx == '!MEM SNAP!':
+            report, summary = MEMTRACER.snap()
+            pfn = prof_write('mem', report)
+            return '%s -> %s' % (summary, pfn)
+        elif rx == '!MEM STOP!':
+            MEMTRACER.stop()
+            return 'tracemalloc stopped'
+        else:
+            raise ValueError('unknown command')
+
+####################################################################################################
+
 # Threaded socketserver from Python standard library.
 
 NCX = 0     # Number of server connections.
@@ -497,81 +1038,341 @@ def create_server_socket(address):
     _sl.trace('listening at {}'.format(address))
     return listener
 
+# Oversized records.
+#
+#   --max_rec   = Max record bytes (default 1048576), enforced as bytes
+#                 arrive, so a huge or unterminated line is never held.
+#   --oversize  = discard (default): drop it.
+#                 truncate: store a stub record with its first --trunc_len
+#                 bytes as _head and its size as _trunc.
+#                 Either way, NAK'd and counted (RXSTATS).
+#   --trunc_len = Bytes kept as _head (default 4096, at most --max_rec / 8,
+#                 so that the json'd stub stays within --max_rec).
+#   --spill_rec = Records over this many bytes (but within --max_rec)
+#                 are written, as they arrive, to <blob dir>/<SHA1>.json
+#                 and stored as a stub with _blob (the blob's SHA1) and
+#                 _bsz (its size).  Default: no spilling.  A spilled
+#                 frame that isn't a json dict (e.g., a control line,
+#                 or malformed json) is NAK'd and its blob removed.
+#                 As for other frames, trailing whitespace is stripped.
+#   --blob_path = Blob dir (default: blobs/ next to the flatfiles).
+#
+# Stubs keep the record's _id, _si, _el, _sl and _ts, found in its head.
+
+MAX_REC   = int(_a.ARGS.get('--max_rec') or 1048576)
+OVERSIZE  = _a.ARGS.get('--oversize') or 'discard'
+if OVERSIZE not in ('discard', 'truncate'):
+    raise ValueError('bad --oversize: %r' % OVERSIZE)
+SPILL_REC = int(_a.ARGS.get('--spill_rec') or 0) or None
+BLOB_PATH = _a.ARGS.get('--blob_path')
+HEADLEN   = 256         # Bytes of an oversize record kept for the log (discard) and stub keys.
+TRUNC_LEN = min(int(_a.ARGS.get('--trunc_len') or 4096), MAX_REC // 8)
+
+RXSTATS = collections.Counter()     # discarded, truncated, spilled.
+
+def blob_dir():
+    return BLOB_PATH or os.path.join(os.path.dirname(LOG_PFN or current_log_pfn() or '') or '.', 'blobs')
+
+# The prefix keys of a record, from its head (bytes).
+HEADKEYS = re.compile(rb'"(_id|_si|_el|_sl|_ts)"\s*:\s*("(?:[^"\\]|\\.)*"|-?[0-9][0-9.]*)')
+def head_fields(head):
+    d = collections.OrderedDict()
+    for m in HEADKEYS.finditer(head):
+        try:
+            d[m.group(1).decode()] = json.loads(m.group(2))
+        except ValueError:
+            pass
+    return d
+
+Oversize = collections.namedtuple('Oversize', 'size head')      # Dropped: size, first bytes.
+Spilled = collections.namedtuple('Spilled', 'pfn sha1 size head new')   # new: blob not there before.
+
+# Is a Spilled's blob a json dict (as reformatLogrec requires of a record)?
+def blob_dict(spilled):
+    if spilled.head[:1] != b'{':
+        return False
+    try:
+        with open(spilled.pfn, 'rb') as f:
+            return isinstance(json.load(f), dict)
+    except (OSError, ValueError):
+        return False
+
+# Remove the blob of a Spilled that isn't stored (unless an earlier record's).
+def unblob(spilled):
+    if spilled.new:
+        try:
+            os.remove(spilled.pfn)
+        except OSError:
+            pass
+
+class LineReader(object):
+    """Split a socket's byte stream into '\n'-terminated frames."""
+    # Receives into one reusable bytearray (via recv_into a memoryview),
+    # finds frames in place, and copies out only each frame's bytes.
+    # No decoding: that's left to whoever parses the frame.
+    # With maxrec, a frame over maxrec bytes isn't kept: readline gives
+    # an Oversize (with its first keep bytes) instead.  With spill, a
+    # frame over spill bytes goes to a file in spilldir() as it arrives:
+    # readline gives a Spilled.  Either way buf stays about maxrec (or
+    # spill) + bufsize, at most.
+
+    def __init__(self, skt, bufsize=65536, maxrec=None, keep=HEADLEN, spill=None, spilldir=None):
+        self.skt = skt
+        self.buf = bytearray(bufsize)
+        self.mv = memoryview(self.buf)
+        self.beg = 0            # Start of unconsumed bytes in buf.
+        self.end = 0            # End of received bytes in buf.
+        self.scan = 0           # buf[beg:scan] has been searched: no '\n' there.
+        self.maxrec = maxrec
+        self.keep = keep
+        self.spill = spill
+        self.spilldir = spilldir
+        self.over = None        # None, 'spill' or 'discard': the current frame's fate.
+        self.size = 0           # Bytes of the current (spilled/discarded) frame so far.
+        self.head = None        # Its first bytes.
+        self.sf = self.sfpfn = self.sh = None   # Spill file, its pfn, its SHA1.
+        self.bsize = 0          # Bytes written to the spill file.
+        self.ws = bytearray()   # Trailing whitespace held back from it (stripped, if last).
+
+    def readline(self):
+        """Next frame as bytes (trailing whitespace stripped), Oversize or Spilled.  None at EOF."""
+        buf = self.buf
+        while True:
+            i = buf.find(b'\n', max(self.scan, self.beg), self.end)
+            j = i if i >= 0 else self.end
+            self.scan = self.end if i < 0 else 0
+            if self.over or (self.spill and (j - self.beg) > self.spill) or \
+               (self.maxrec and (j - self.beg) > self.maxrec):
+                # Too big to hold: hand these bytes over.
+                self.take(j)
+                if i >= 0:
+                    self.beg = i + 1
+                    return self.finish()
+            elif i >= 0:
+                while j > self.beg and buf[j-1] in b' \t\r':
+                    j -= 1
+                frame = bytes(self.mv[self.beg:j])
+                self.beg = i + 1
+                return frame
+            # No complete frame: make room at the end, then receive.
+            if self.beg:
+                n = self.end - self.beg
+                self.mv[:n] = self.mv[self.beg:self.end]
+                self.scan = max(self.scan - self.beg, 0)
+                self.beg, self.end = 0, n
+            if self.end == len(buf):
+                # A frame longer than the buffer: double it.
+                self.mv.release()
+                buf.extend(bytes(len(buf)))
+                self.mv = memoryview(buf)
+            n = self.recv()
+            if not n:
+                # EOF.  An unterminated last frame is still a frame.
+                if self.over:
+                    return self.finish()
+                if self.end > self.beg:
+                    frame = bytes(self.mv[self.beg:self.end]).rstrip()
+                    self.beg = self.end = self.scan = 0
+                    return frame
+                return None
+            self.end += n
+
+    # (Its own function, so a profile sees a blocked reader as blocked.)
+    def recv(self):
+        return self.skt.recv_into(self.mv[self.end:])
+
+    # Hand over buf[beg:j] of a frame too big to hold, to a spill file or the bit bucket.
+    def take(self, j):
+        z = self.mv[self.beg:j]
+        if not self.over:
+            self.head = bytearray()
+            self.over = 'spill' if (self.spill and (not self.maxrec or self.spill < self.maxrec)) else 'discard'
+            if self.over == 'spill':
+                p = self.spilldir()
+                if not os.path.isdir(p):
+                    os.makedirs(p)
+                self.sfpfn = os.path.join(p, '.spill-%d.tmp' % id(self))
+                self.sf = open(self.sfpfn, 'wb')
+                self.sh = hashlib.sha1()
+        if len(self.head) < self.keep:
+            self.head += z[:self.keep - len(self.head)]
+        self.size += len(z)
+        if self.over == 'spill':
+            if self.maxrec and self.size > self.maxrec:
+                # Too big even to spill.
+                self.unspill()
+                self.over = 'discard'
+            else:
+                # As for frames in buf, trailing whitespace isn't part of the frame.
+                k = len(z)
+                while k and z[k-1] in b' \t\r':
+                    k -= 1
+                if k:
+                    if self.ws:
+                        self.spillwrite(self.ws)
+                    self.spillwrite(z[:k])
+                    self.ws = bytearray(z[k:])
+                else:
+                    self.ws += z
+        z.release()
+        self.beg = j
+
+    def spillwrite(self, z):
+        self.sf.write(z)
+        self.sh.update(z)
+        self.bsize += len(z)
+
+    def unspill(self):
+        try:
+            self.sf.close()
+            os.remove(self.sfpfn)
+        except OSError:
+            pass
+        self.sf = self.sfpfn = self.sh = None
+        self.bsize, self.ws = 0, bytearray()
+
+    # The current frame is complete: Spilled or Oversize.
+    def finish(self):
+        if self.over == 'spill':
+            self.sf.close()
+            sha1x = self.sh.hexdigest()
+            pfn = os.path.join(os.path.dirname(self.sfpfn), sha1x + '.json')
+            new = not os.path.exists(pfn)
+            os.replace(self.sfpfn, pfn)
+            rv = Spilled(pfn, sha1x, self.bsize, bytes(self.head), new)
+        else:
+            rv = Oversize(self.size, bytes(self.head))
+        self.sf = self.sfpfn = self.sh = None
+        self.bsize, self.ws = 0, bytearray()
+        self.over, self.size, self.head = None, 0, None
+        return rv
+
+    def close(self):
+        if self.sf:
+            self.unspill()
+
 def handle_connection(skt, address):
     global NCX, NOCX, XLOGSTOP
     try:
         NCX += 1
         NOCX += 1
-        _sl.info('handle_connection: %d (%d open): %r' % (NCX, NOCX, address))
-        with skt.makefile(encoding=ENCODING, errors=ERRORS, newline='\n')as cf:
-            while True:
-                rx = cf.readline()
-                tx = None
-                #$#ml.debug('rx: %r' % rx.rstrip())#$#
-                if rx:
-                    rx = rx.rstrip()
-                    if not rx:
-                        continue
-                        # ??? Or, should this be ACK'd with an OK?
-                    if   rx[0] == '!' and rx[-1] == '!':
+        _dl.info('connect', 'handle_connection: %d (%d open): %r', NCX, NOCX, address, src=address[0])
+        lr = LineReader(skt, maxrec=MAX_REC, keep=(max(TRUNC_LEN, HEADLEN) if OVERSIZE == 'truncate' else HEADLEN),
+                        spill=SPILL_REC, spilldir=blob_dir)
+        _ip = address[0]        # Connection state, injected into each record by reformatLogrec.
+        hello = None            # Connection defaults, from '!HELLO {...}!'.
+        while True:
+            rx = lr.readline()
+            tx = None
+            #$#ml.debug('rx: %r' % rx)#$#
+            if rx is None:
+                # Connection EOF.
+                _dl.info('disconnect', 'no more rx', src=address[0])
+                break
+            if   isinstance(rx, Oversize):
+                # NAK'd.  A stub record, if truncating.
+                if OVERSIZE == 'truncate':
+                    stub = head_fields(rx.head)
+                    stub['_trunc'] = rx.size
+                    stub['_head'] = rx.head[:TRUNC_LEN].decode(encoding=ENCODING, errors='replace')
+                    (rc, rm, newrec) = reformatLogrec(json.dumps(stub, ensure_ascii=True).encode(encoding=ENCODING, errors=ERRORS), _ip, hello=hello)
+                    if rc:
+                        LFQ.put(newrec)
+                RXSTATS['truncated' if OVERSIZE == 'truncate' else 'discarded'] += 1
+                _dl.warning('oversize', 'oversize record (%s): %d bytes: %r...', OVERSIZE, rx.size, rx.head[:HEADLEN], src=_ip)
+                tx = ('E: oversize record: %d bytes (max %d)' % (rx.size, MAX_REC)).encode(encoding=ENCODING, errors=ERRORS)
+            elif isinstance(rx, Spilled):
+                # A stub record pointing at the blob.  (Only for a json dict:
+                # not, e.g., a huge control line or a malformed record.)
+                if not blob_dict(rx):
+                    rc, rm = False, 'bad json dict (%d bytes)' % rx.size
+                    _dl.error('bad json dict', 'bad json dict: %d bytes: %r', rx.size, rx.head[:HEADLEN], src=_ip)
+                else:
+                    stub = head_fields(rx.head)
+                    stub['_blob'] = rx.sha1
+                    stub['_bsz'] = rx.size
+                    (rc, rm, newrec) = reformatLogrec(json.dumps(stub, ensure_ascii=True).encode(encoding=ENCODING, errors=ERRORS), _ip, hello=hello)
+                if rc:
+                    LFQ.put(newrec)
+                    RXSTATS['spilled'] += 1
+                    tx = b'OK'
+                else:
+                    unblob(rx)
+                    tx = ('E: ' + rm).encode(encoding=ENCODING, errors=ERRORS)
+            elif not rx:
+                continue
+                # ??? Or, should this be ACK'd with an OK?
+            elif rx[:1] == b'!' and rx[-1:] == b'!':
+                # Control lines are the only ones decoded here.
+                rx = rx.decode(encoding=ENCODING, errors=ERRORS)
+                if   rx.startswith('!HELLO '):
+                    try:
+                        hello = Hello(rx[len('!HELLO '):-1])
+                        if not hello.defaults:
+                            hello = None        # '!HELLO {}!' clears.
                         tx = b'OK|' + rx.encode(encoding=ENCODING, errors=ERRORS)
-                    elif rx == '!STOP!':
-                        XLOGSTOP = True
-                        tx = b'OK'
-                    else:
-                        # Should be a log record.
-                        # Add the source IP.
-                        logrec = address[0] + _ + rx
-                        # Reformat to final log file format.
-                        (rc, rm, newrec) = reformatLogrec(logrec)
-                        # Queue to log file writing thread.
-                        if rc:
-                            LFQ.put(newrec)
-                            tx = b'OK'
-                        else:
-                            # Instead of an 'OK', echo the bad record.
-                            tx = 'E: ' + rm             # The squawk from xlog.
-                            z  = ':: ' + logrec         # The offending logrec.
-                            _sl.error(tx)#$#             
-                            _sl.error(z)#$#                 
-                            tx = tx.encode(encoding=ENCODING, errors=ERRORS)
-                    # Respond to sender.
-                    if tx:
-                        skt.sendall(tx + b'\n')
+                    except ValueError as E:
+                        tx = 'E: %s: %s' % (rx, E)
+                        _dl.error('hello', tx, src=_ip)#$#
+                        tx = tx.encode(encoding=ENCODING, errors=ERRORS)
+                elif rx.startswith('!RELAY '):
+                    tx = relay_rx(lr, rx, _ip).encode(encoding=ENCODING, errors=ERRORS)
+                elif rx.startswith('!PROF ') or rx.startswith('!MEM '):
+                    try:
+                        tx = 'OK|' + rx + '|' + prof_command(rx)
+                    except Exception as E:
+                        tx = 'E: %s: %s' % (rx, E)
+                        _dl.error('prof', tx)#$#
+                    tx = tx.encode(encoding=ENCODING, errors=ERRORS)
+                elif rx[0] == '!' and rx[-1] == '!':
+                    tx = b'OK|' + rx.encode(encoding=ENCODING, errors=ERRORS)
+                elif rx == '!STOP!':
+                    XLOGSTOP = True
+                    tx = b'OK'
+            else:
+                # Should be a log record.
+                # Reformat to final log file format.
+                (rc, rm, newrec) = reformatLogrec(rx, _ip, hello=hello)
+                # Queue to log file writing thread.
+                if rc:
+                    LFQ.put(newrec)
+                    tx = b'OK'
                 else:
-                    # Connection EOF.
-                    _sl.info('no more rx')
-                    break
-        _sl.info('skt.makefile done')
+                    # Instead of an 'OK', the squawk.
+                    # (reformatLogrec has logged it, with the record's head.)
+                    tx = 'E: ' + rm             # The squawk from xlog.
+                    tx = tx.encode(encoding=ENCODING, errors=ERRORS)
+            # Respond to sender.
+            if tx:
+                skt.sendall(tx + b'\n')
+        _dl.info('disconnect', 'rx done', src=address[0])
     except EOFError:
-        _m.beeps(1)
-        msg = 'client socket to {} has closed'.format(address)
-        _sl.warning(msg)
+        _dl.beeps(1)
+        _dl.warning('closed', 'client socket to %s has closed', address, src=address[0])
         pass            # POR.
     except ConnectionResetError as E:
-        _m.beeps(1)     # Usually not serious.
-        msg = 'client {} closed connection'.format(address)
-        _sl.info(msg)
+        _dl.beeps(1)    # Usually not serious.
+        _dl.info('closed', 'client %s closed connection', address, src=address[0])
         pass            # POR.
     except ConnectionAbortedError as E:
-        _m.beeps(2)     # Perhaps a little more serious.
-        msg = 'client {} aborted connection'.format(address)
-        _sl.info(msg)
+        _dl.beeps(2)    # Perhaps a little more serious.
+        _dl.info('aborted', 'client %s aborted connection', address, src=address[0])
         pass            # POR.
     except Exception as E:
-        _m.beeps(3)
-        errmsg = 'client {} error: {} @ {}'.format(address, E, _m.tblineno())
-        _sl.error(errmsg)
+        _dl.beeps(3)
+        _dl.error('client error', 'client %s error: %s @ %s', address, E, _m.tblineno(), src=address[0])
         pass            # POR.
     finally:
-        msg = 'handle_connection: close -> %d open' % NOCX
-        _sl.info(msg)
+        _dl.info('disconnect', 'handle_connection: close -> %d open', NOCX, src=address[0])
         NOCX -= 1
+        try:  lr.close()
+        except: pass
         try:  skt.close()
         except: pass
 
 class Handler(BaseRequestHandler):
     def handle(self):
+        threading.current_thread().name = 'handler %s:%d' % self.client_address[:2]
         handle_connection(self.request, self.client_address)
 
 class ThreadedServer(ThreadingMixIn, TCPServer):
@@ -583,7 +1384,7 @@ XLOGSTOP = None             # Distinct from LFTSTOP.  Used for remote shutdown v
 # main: xlog
 #
 def xlog():
-    global LFTSTOP 
+    global LFTSTOP, RLTSTOP
     me, action = 'main', ''
     try:
         _sl.info(me + ' begins')#$#
@@ -593,18 +1394,26 @@ def xlog():
         _sl.info('     port: ' + str(PORT))
         _sl.info('       hp: ' + str(HP))
         _sl.info(' log_path: ' + LOG_PATH)
+        if SQLITE_PATH:
+            _sl.info('   sqlite: ' + SQLITE_PATH)
         _sl.info('  verbose: ' + str(VERBOSE))
+        if RELAY_HP:
+            _sl.info('    relay: ' + str(RELAY_HP))
         if VERBOSE:
             _sl.info('   viewer: ' + str(VIEWER))
             _sl.info('       vm: ' + repr(VM))
         _sl.info()
 
         startLogFileThread()
+        if RELAY_HP:
+            startRelayThread()
+        if ALERTS:
+            startAlertThread()
 
         # Fake a log record from self.  Fake the json'd dict.  Use '0.0.0.0' as self.
-        z = '%s%s{"_id": "%s", "_si": "%s", "_el": %d, "_sl": "%s", "_msg": "%s"}' %\
-            ('0.0.0.0', _, '----', '----', 0, '_', (me + ' begins @ %s' % _dt.ut2iso(_dt.locut())))
-        (rc, rm, newrec) = reformatLogrec(z)
+        z = '{"_id": "%s", "_si": "%s", "_el": %d, "_sl": "%s", "_msg": "%s"}' %\
+            ('----', '----', 0, '_', (me + ' begins @ %s' % _dt.ut2iso(_dt.locut())))
+        (rc, rm, newrec) = reformatLogrec(z.encode(encoding=ENCODING, errors=ERRORS), '0.0.0.0')
         LFQ.put(newrec)
 
         _sl.info('starting server on %r' % (HP, ))
@@ -636,11 +1445,17 @@ def xlog():
         raise
     finally:
         # Either: a '!STOP!' record, a KeyboardInterrupt, or an Exception.
+        if ALT:
+            # Wait some to let ALT evaluate what's queued (its 'record' alerts go to LFQ).
+            tw, w = 0, 0.1
+            while tw < 5 and ALQ.unfinished_tasks:
+                time.sleep(w)
+                tw += w
         if LFT:
             # Fake a received log record.
-            z = '%s%s{"_id": "%s", "_el": %d, "_sl": "%s", "_msg": "%s"}' %\
-                ('0.0.0.0', _, '----', 0, '_', (me + ' ends @ %s' % _dt.ut2iso(_dt.locut())))
-            (rc, rm, newrec) = reformatLogrec(z)
+            z = '{"_id": "%s", "_el": %d, "_sl": "%s", "_msg": "%s"}' %\
+                ('----', 0, '_', (me + ' ends @ %s' % _dt.ut2iso(_dt.locut())))
+            (rc, rm, newrec) = reformatLogrec(z.encode(encoding=ENCODING, errors=ERRORS), '0.0.0.0')
             LFQ.put(newrec)
 
             # Wait some to let LFT empty tis queue.
@@ -669,8 +1484,20 @@ def xlog():
                 DOSQUAWK(errmsg)
                 raise
 
+        if RLT:
+            # Wait some to let RLT relay what it holds.
+            tw, w = 0, 0.1
+            while tw < 10 and (not RLQ.empty() or RLBUSY):
+                time.sleep(w)
+                tw += w
+            RLTSTOP = True
+            RLT.join(5)
+
         try:  LOG_FILE.close()
         except:  pass
+        if RXSTATS:
+            _sl.info('rx stats: %r' % dict(RXSTATS))
+        _dl.close()
         _sl.info(me + ' ends')#$#
 
 # Test data
@@ -686,9 +1513,9 @@ if __name__ == '__main__':
     '''...
     # Test crunching.
     t0 = time.time()
-    A = '192.168.100.6|' + A1
+    A = A1.encode()
     for x in range(1000):
-        (rc, rm, B) = reformatLogRec(A)
+        (rc, rm, B) = reformatLogrec(A, '192.168.100.6')
     t1 = time.time()
     print('%.3f ms/reformat' % (1000.0 * (t1 - t0) / 1000.0))
     # -> 0.125 ms/reformat
@@ -0,0 +1,137 @@
+#> !P3!
+
+"""
+xmerge: Merge xlog flatfiles (e.g., from several xlog servers) by timestamp.
+
+Usage:
+  xmerge.py [--key=<key> --dedup --window=<window> --out=<out>] <pfn>...
+  xmerge.py (-h | --help | --version)
+
+Options:
+  -h --help              Show help.
+  --version              Show version.
+  --key=<key>            Merge on rx (server) or tx (client) TS [default: rx].
+  --dedup                Drop records whose SHA1 was already output within --window.
+  --window=<window>      Dedup window, in secs of the merge key [default: 60].
+  --out=<out>            Output pfn (default: stdout).
+"""
+
+###
+### xmerge: - A streaming k-way (heap) merge of any number of FFV 0/1/2
+###           flatfiles, plain or compressed, into one stream of lines.
+###         - Each input is expected in merge key order (a flatfile is
+###           in rx order, unless it holds relayed records; tx order is
+###           only as good as the clients' clocks).  Lines out of order
+###           are still output, where they fall, but counted per input
+###           and reported (on stderr): sort such inputs first.
+###         - The merge key is sliced from the fixed-width (15 char)
+###           timestamp columns, compared as strings, so lines are not
+###           split.  A line whose columns aren't where they should be
+###           (e.g., an odd client _ts) is parsed instead.  A line that
+###           isn't whole (its separator count is off, or it doesn't
+###           end in '}', e.g. a torn last line) is skipped.
+###         - Optional SHA1 dedup across inputs (e.g., a record relayed
+###           to, or sent to, two servers) remembers only the SHA1s
+###           output within the last --window secs.
+###         - Memory: a line per input, plus the dedup window.
+###
+
+import sys, heapq, collections
+
+import xflatfile as _ff
+
+TSLEN = 15              # '{:15.4f}'
+
+# Fixed column offsets: (rx, tx) starts, per FFV.
+OFFSETS = {
+    '0': (0, TSLEN + 1),
+    '1': (2, 2 + TSLEN + 1),
+    '2': (2, 2 + TSLEN + 1),
+}
+
+# Separators in a whole line, at least, per FFV.  (FFV 0 json can hold
+# '|'s.  FFV 1/2 json can't hold tabs, so FFV 1 has exactly 8.)
+NSEPS = {'0': 7, '1': 8, '2': 8}
+
+def keyfunc(key):
+    """A line -> merge key function, for key 'rx' or 'tx'."""
+    if key not in ('rx', 'tx'):
+        raise ValueError('bad key: %r' % key)
+    ix = 0 if key == 'rx' else 1
+    seps = {'0': '|', '1': '\t', '2': '\t'}
+    def f(line):
+        ffv = line[0] if line[1:2] == '\t' else '0'
+        sep = seps.get(ffv, '|')
+        n = line.count(sep)
+        if line[-1:] != '}' or n < NSEPS.get(ffv, 7) or (ffv == '1' and n != 8):
+            raise ValueError('malformed line: %r' % line[:100])
+        b = OFFSETS.get(ffv, OFFSETS['0'])[ix]
+        if line[b + TSLEN:b + TSLEN + 1] == sep and (b == 0 or line[b-1] == sep):
+            return line[b:b + TSLEN]
+        return getattr(_ff.parse(line), key)
+    return f
+
+# (merge key, line without '\n') of one flatfile, skipping blank and malformed lines.
+# Lines whose key is below an earlier one's are counted in disorder[pfn].
+def keyed_lines(pfn, kf, disorder=None):
+    top = None
+    with _ff.open_flatfile(pfn) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            try:
+                k = kf(line)
+            except ValueError:
+                continue
+            if top is None or k >= top:
+                top = k
+            elif disorder is not None:
+                disorder[pfn] += 1
+            yield (k, line)
+
+def merge(pfns, key='rx', dedup=False, window=60.0, disorder=None):
+    """Yield the lines of pfns merged on key, optionally SHA1-dedup'd.
+    Out of order lines are counted, per pfn, in disorder (a Counter), if given."""
+    kf = keyfunc(key)
+    merged = heapq.merge(*[keyed_lines(pfn, kf, disorder) for pfn in pfns])
+    if not dedup:
+        for k, line in merged:
+            yield line
+        return
+    seen = set()                    # SHA1s in the window.
+    order = collections.deque()     # (key, sha1), oldest first, for eviction.
+    for k, line in merged:
+        try:
+            rec = _ff.parse(line)
+        except ValueError:
+            continue                    # (keyfunc let it by.)
+        try:
+            k = float(k)
+        except ValueError:
+            yield line                  # No usable TS: can't window it.
+            continue
+        while order and order[0][0] < k - window:
+            seen.discard(order.popleft()[1])
+        if rec.sha1 in seen:
+            continue
+        seen.add(rec.sha1)
+        order.append((k, rec.sha1))
+        yield line
+
+if __name__ == '__main__':
+
+    import docopt
+
+    ARGS = docopt.docopt(__doc__, version='0.1')
+    out = open(ARGS['--out'], 'w', encoding=_ff.ENCODING, errors=_ff.ERRORS) if ARGS['--out'] else sys.stdout
+    disorder = collections.Counter()
+    try:
+        for line in merge(ARGS['<pfn>'], key=ARGS['--key'], dedup=ARGS['--dedup'], window=float(ARGS['--window']),
+                          disorder=disorder):
+            out.write(line + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        for pfn, n in sorted(disorder.items()):
+            sys.stderr.write('xmerge: %s: %d lines out of %s order\n' % (pfn, n, ARGS['--key']))
@@ -0,0 +1,164 @@
+#> !P3!
+
+###
+### xprof: On-demand profiling for a running xlog.
+###        - Sampler: a lightweight sampling profiler.  A thread that
+###          periodically looks at other threads' stacks (via
+###          sys._current_frames), so the handler threads and LFT
+###          are covered without being instrumented.  Only threads
+###          whose name passes select() are sampled.  Overhead is
+###          bounded by the sampling interval and a maximum run time.
+###        - Only busy samples count towards the profile.  Where the
+###          platform has per-thread CPU clocks (Linux), a sample is
+###          weighted by the CPU time its thread used since the last
+###          one (none: idle).  Elsewhere each sample weighs 1.  Either
+###          way, a sample whose top frame is a blocking call (BLOCKING)
+###          is idle.  Idle samples are reported separately.
+###        - MemTracer: tracemalloc start, snapshots (diffed against
+###          the previous one) and stop.
+###        Reports are returned as text, for writing to a file, plus
+###        a one-line summary for the reply to the client.
+###
+
+import os, sys, time, threading, collections, tracemalloc
+
+MAXDEPTH = 64           # Stack frames walked per sample.
+
+# Top-of-stack functions that mean a thread is blocked, not working.
+BLOCKING = frozenset(('wait', 'select', 'poll', 'get', 'sleep', 'accept', 'recv', 'recv_into', 'join'))
+
+CPUCLOCKS = hasattr(time, 'pthread_getcpuclockid')
+
+def _where(code):
+    return '%s:%d(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+class Sampler(threading.Thread):
+
+    def __init__(self, interval=0.005, maxsecs=600, select=None):
+        threading.Thread.__init__(self, name='xprof-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.maxsecs = maxsecs
+        self.select = select or (lambda name: True)     # Thread name -> sample it?
+        self.stopper = threading.Event()
+        self.nsamples = 0
+        self.nbusy = self.nidle = 0             # Thread samples.
+        self.t0 = self.t1 = None
+        self.cpu = {}                           # Thread ident -> its CPU clock at the last sample.
+        self.own = collections.Counter()        # Busy weight with function on top of stack.
+        self.cum = collections.Counter()        # Busy weight with function anywhere on stack.
+        self.threads = collections.Counter()    # Busy weight per thread name.
+        self.idle = collections.Counter()       # Idle samples per top of stack.
+
+    # A thread's CPU secs since its last sample (None: not known yet, or no CPU clocks).
+    def cpu_delta(self, tid):
+        if not CPUCLOCKS:
+            return None
+        try:
+            t = time.clock_gettime(time.pthread_getcpuclockid(tid))
+        except (OSError, ValueError, OverflowError):
+            return None
+        last, self.cpu[tid] = self.cpu.get(tid), t
+        return None if last is None else (t - last)
+
+    def run(self):
+        me = threading.get_ident()
+        self.t0 = time.time()
+        try:
+            while not self.stopper.is_set() and (time.time() - self.t0) < self.maxsecs:
+                names = dict((t.ident, t.name) for t in threading.enumerate())
+                for tid, frame in sys._current_frames().items():
+                    name = names.get(tid, str(tid))
+                    if tid == me or not self.select(name):
+                        continue
+                    d = self.cpu_delta(tid)
+                    top = _where(frame.f_code)
+                    if frame.f_code.co_name in BLOCKING or (d is not None and d <= 0):
+                        self.nidle += 1
+                        self.idle[top] += 1
+                        continue
+                    if CPUCLOCKS and d is None:
+                        continue                # First sight of the thread: no delta yet.
+                    w = d if CPUCLOCKS else 1
+                    self.nbusy += 1
+                    self.threads[name] += w
+                    self.own[top] += w
+                    seen, depth = set(), 0
+                    while frame is not None and depth < MAXDEPTH:
+                        z = _where(frame.f_code)
+                        if z not in seen:
+                            seen.add(z)
+                            self.cum[z] += w
+                        frame, depth = frame.f_back, depth + 1
+                self.nsamples += 1
+                self.stopper.wait(self.interval)
+        finally:
+            self.t1 = time.time()
+
+    def stop(self):
+        self.stopper.set()
+        self.join(max(1, 10 * self.interval))
+
+    def report(self, top=40):
+        """Full text report."""
+        secs = (self.t1 or time.time()) - self.t0
+        weight = 'CPU secs' if CPUCLOCKS else 'samples'
+        lines = ['sampling profile: %d samples in %.1f secs (interval %.4f)' % (self.nsamples, secs, self.interval),
+                 'thread samples: %d busy, %d idle; busy weighted by %s' % (self.nbusy, self.nidle, weight), '']
+        tn = sum(self.threads.values()) or 1
+        lines.append('busy by thread:')
+        for name, n in self.threads.most_common():
+            lines.append('  %6.1f%%  %s' % (100.0 * n / tn, name))
+        for title, counter in (('busy own (top of stack)', self.own), ('busy cumulative (on stack)', self.cum)):
+            lines.append('')
+            lines.append('%s, top %d:' % (title, top))
+            for w, n in counter.most_common(top):
+                lines.append('  %6.1f%%  %10.4g  %s' % (100.0 * n / tn, n, w))
+        lines.append('')
+        lines.append('idle (blocked) samples, top %d:' % top)
+        for w, n in self.idle.most_common(top):
+            lines.append('  %8d  %s' % (n, w))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, top=3):
+        """One-line summary."""
+        tn = sum(self.threads.values()) or 1
+        z = ', '.join('%s %.0f%%' % (w, 100.0 * n / tn) for w, n in self.own.most_common(top))
+        return '%d samples (%d busy, %d idle); busy top: %s' % (self.nsamples, self.nbusy, self.nidle, z or '-')
+
+class MemTracer(object):
+
+    def __init__(self, nframes=1):
+        self.nframes = nframes
+        self.last = None        # Previous snapshot, for diffs.
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.nframes)
+        self.last = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self.last = None
+
+    def snap(self, top=40):
+        """Take a snapshot.  Returns (report, summary)."""
+        if not tracemalloc.is_tracing():
+            raise ValueError('tracemalloc not started')
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), ))
+        cur, peak = tracemalloc.get_traced_memory()
+        lines = ['tracemalloc: current %.1f KiB, peak %.1f KiB' % (cur / 1024.0, peak / 1024.0), '']
+        stats = snapshot.statistics('lineno')
+        lines.append('top %d by size:' % top)
+        for st in stats[:top]:
+            lines.append('  %s' % st)
+        if self.last is not None:
+            lines.append('')
+            lines.append('top %d changes since last snapshot:' % top)
+            for st in snapshot.compare_to(self.last, 'lineno')[:top]:
+                lines.append('  %s' % st)
+        self.last = snapshot
+        z = '; '.join('%s:%d %.1f KiB' % (os.path.basename(st.traceback[0].filename), st.traceback[0].lineno, st.size / 1024.0) for st in stats[:3])
+        summary = 'current %.1f KiB, peak %.1f KiB; top: %s' % (cur / 1024.0, peak / 1024.0, z)
+        return ('\n'.join(lines) + '\n', summary)
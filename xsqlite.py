@@ -0,0 +1,200 @@
+#> !P3!
+
+"""
+xsqlite: Load xlog flatfiles into SQLite.
+
+Usage:
+  xsqlite.py --db=<db> [--batch=<batch>] <pfn>...
+  xsqlite.py (-h | --help | --version)
+
+Options:
+  -h --help              Show help.
+  --version              Show version.
+  --db=<db>              SQLite database pfn (created if need be).
+  --batch=<batch>        Records per executemany/transaction [default: 50000].
+"""
+
+###
+### xsqlite: - SQLiteSink: an optional xlog output sink, used by
+###            logFileThread alongside the flatfile writer (via
+###            --sqlite_path, with the same ~ymd~ etc. substitutions
+###            as --log_path).  Records are inserted in batched
+###            transactions into a WAL-mode database.
+###          - load(): a bulk loader for existing FFV 0/1/2 flatfiles,
+###            feeding executemany from the streaming flatfile parser.
+###          - The prefix fields are indexed columns, the json is a
+###            text column.  (sha1, rx) is unique, so reloading a
+###            flatfile is harmless.
+###          - A failed batch (e.g., 'database is locked', disk full)
+###            is kept and retried after RETRY secs.  Past maxrows
+###            pending rows, the oldest are dropped (and counted).
+###            The sink's busy timeout is short: it must not hold up
+###            the flatfile writer.
+###
+
+import os, time, itertools, sqlite3
+
+import xflatfile as _ff
+
+COLUMNS = ('ffv', 'rx', 'tx', 'id', 'si', 'el', 'sl', 'sha1', 'js')
+
+CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS logrecs (
+    ffv  TEXT,
+    rx   TEXT,
+    tx   TEXT,
+    id   TEXT,
+    si   TEXT,
+    el   TEXT,
+    sl   TEXT,
+    sha1 TEXT,
+    js   TEXT)'''
+
+# Unique, so needed up front for INSERT OR IGNORE.
+CREATE_UNIQUE = 'CREATE UNIQUE INDEX IF NOT EXISTS logrecs_sha1_rx ON logrecs (sha1, rx)'
+
+CREATE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS logrecs_rx ON logrecs (rx)',
+    'CREATE INDEX IF NOT EXISTS logrecs_tx ON logrecs (tx)',
+    'CREATE INDEX IF NOT EXISTS logrecs_id_si ON logrecs (id, si)',
+    'CREATE INDEX IF NOT EXISTS logrecs_el ON logrecs (el)',
+    'CREATE INDEX IF NOT EXISTS logrecs_sl ON logrecs (sl)',
+)
+
+INSERT = 'INSERT OR IGNORE INTO logrecs (%s) VALUES (%s)' % \
+         (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+
+RETRY = 5.0             # Secs after a failed flush before the sink tries again.
+TIMEOUT = 0.5           # Sink's busy timeout, secs.
+
+def connect(dbpfn, timeout=5.0):
+    (p, fn) = os.path.split(dbpfn)
+    if p and not os.path.isdir(p):
+        os.makedirs(p)
+    # isolation_level=None: transactions are explicit (BEGIN/COMMIT).
+    con = sqlite3.connect(dbpfn, isolation_level=None, timeout=timeout)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.execute(CREATE_TABLE)
+    con.execute(CREATE_UNIQUE)
+    return con
+
+def create_indexes(con):
+    for z in CREATE_INDEXES:
+        con.execute(z)
+
+# An FFRec as a row for INSERT.
+def rec2row(rec):
+    return (rec.ffv, rec.rx, rec.tx, rec.id, rec.si, rec.el, rec.sl, rec.sha1, rec.js)
+
+####################################################################################################
+
+# Output sink.  Only used from logFileThread (sqlite3 connections are
+# bound to their creating thread).  flush() and roll() raise on sqlite
+# errors (the rows are kept): the caller logs them and carries on.
+
+class SQLiteSink(object):
+
+    def __init__(self, batch=1000, maxrows=None):
+        self.batch = batch
+        self.maxrows = maxrows or 100 * batch
+        self.pfn = None         # Current (per-day) database pfn.
+        self.con = None
+        self.rows = []          # Pending rows, inserted by flush().
+        self.nrecs = 0          # Records committed.
+        self.dropped = 0        # Rows dropped (over maxrows while failing).
+        self.retry = 0          # Time of the next flush after a failure.
+
+    # Switch to another database pfn (a day roll).  Commits pending rows
+    # first: if that fails, stays on the current pfn.
+    def roll(self, pfn):
+        if pfn == self.pfn:
+            return
+        if self.pfn:
+            self.flush(force=True)
+        self.close()
+        self.pfn = pfn
+
+    def add(self, logrec):
+        """Queue a flatfile record (str); flush when a batch is full."""
+        self.rows.append(rec2row(_ff.parse(logrec)))
+        if len(self.rows) >= self.batch:
+            self.flush()
+
+    def flush(self, force=False):
+        """Insert the pending rows in one transaction (unless retrying later)."""
+        if not self.rows or (not force and time.time() < self.retry):
+            return
+        rows, self.rows = self.rows, []
+        try:
+            if not self.con:
+                self.con = connect(self.pfn, timeout=TIMEOUT)
+                create_indexes(self.con)
+            self.con.execute('BEGIN')
+            try:
+                self.con.executemany(INSERT, rows)
+                self.con.execute('COMMIT')
+            except:
+                try:  self.con.execute('ROLLBACK')
+                except:  pass
+                raise
+        except:
+            # Keep them (ahead of any added since), within maxrows.
+            rows.extend(self.rows)
+            if len(rows) > self.maxrows:
+                self.dropped += len(rows) - self.maxrows
+                del rows[:len(rows) - self.maxrows]
+            self.rows = rows
+            self.retry = time.time() + RETRY
+            raise
+        self.retry = 0
+        self.nrecs += len(rows)
+
+    def close(self):
+        try:
+            self.flush(force=True)
+        finally:
+            if self.con:
+                try:  self.con.close()
+                except:  pass
+            self.con = None
+
+####################################################################################################
+
+# Bulk loader.
+
+# Split an iterable into lazy chunks of up to n items.  Each chunk must be
+# consumed before the next is taken (executemany does).
+def chunks(iterable, n):
+    it = iter(iterable)
+    for first in it:
+        yield itertools.chain((first, ), itertools.islice(it, n - 1))
+
+def load(dbpfn, pfns, batch=50000):
+    """Load flatfiles into dbpfn.  Returns the number of new rows."""
+    con = connect(dbpfn)
+    try:
+        n0 = con.execute('SELECT COUNT(*) FROM logrecs').fetchone()[0]
+        for pfn in pfns:
+            rows = (rec2row(rec) for rec in _ff.iter_records(pfn))
+            for chunk in chunks(rows, batch):
+                con.execute('BEGIN')
+                try:
+                    con.executemany(INSERT, chunk)
+                    con.execute('COMMIT')
+                except:
+                    con.execute('ROLLBACK')
+                    raise
+        # Secondary indexes after the inserts: cheaper than maintaining them row by row.
+        create_indexes(con)
+        n1 = con.execute('SELECT COUNT(*) FROM logrecs').fetchone()[0]
+        return n1 - n0
+    finally:
+        con.close()
+
+if __name__ == '__main__':
+
+    import docopt
+
+    ARGS = docopt.docopt(__doc__, version='0.1')
+    n = load(ARGS['--db'], ARGS['<pfn>'], batch=int(ARGS['--batch']))
+    print('%d rows loaded into %s' % (n, ARGS['--db']))